@@ -0,0 +1,298 @@
+"""
+cache.py
+
+Caches for fetching and analyzing legal decisions:
+- An HTML cache holding the raw HTML of legal decisions by id, persisted with
+  diskcache in HTML_CACHE_DIR.
+- An exact-match cache keyed by the SHA-256 of the model, the prompt version and the
+  legal decision text, persisted with diskcache in RESPONSE_CACHE_DIR.
+- A semantic cache that embeds a legal decision text as a whole with a
+  sentence-transformers model, looks up the most similar previously-analyzed text in a
+  FAISS index and returns the stored analysis from a SQLite table if the texts are
+  near-duplicates. Like the exact-match cache, it is namespaced by the model and the prompt
+  version, each namespace having its own index and table persisted in a subdirectory of
+  CACHE_DIR between runs. The index holds the embeddings under the ids of their rows in the
+  table, so an index that lags behind the table (e.g. after a crash, or when several processes
+  share CACHE_DIR) only misses some analyses and never returns another text's analysis.
+
+faiss and sentence-transformers are slow to import, so they are only loaded when the
+semantic cache is first used.
+"""
+
+import os
+import hashlib
+import sqlite3
+import threading
+import diskcache
+import numpy as np
+
+CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", ".semantic_cache")
+INDEX_FILE = "opinions.faiss"
+DB_FILE = "analyses.sqlite"
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Bump whenever the layout of the semantic cache changes so that stores in an older layout are not read.
+STORE_VERSION = "3"
+
+# The model truncates its input to 256 word pieces, roughly 1000 characters. A legal decision text
+# is embedded as the mean of the embeddings of its consecutive windows of that many characters, so
+# that near-duplicate detection sees the whole text rather than just its caption, dates and counsel.
+WINDOW_CHARS = 1000
+
+# Number of analyses stored in a namespace after which its FAISS index is written to disk. The
+# index is rewritten as a whole, so it is not written after every analysis; `flush` writes the rest.
+FLUSH_EVERY = 100
+
+# Minimum cosine similarity for a cached analysis to be reused.
+SIMILARITY_THRESHOLD = 0.95
+
+# Minimum ratio between the lengths of the shorter and the longer text for a cached analysis to be
+# reused. Copies of the same opinion only differ in formatting, while different opinions in the
+# same case (e.g. panel and rehearing) or revised versions rarely have nearly the same length.
+LENGTH_RATIO_THRESHOLD = 0.98
+
+HTML_CACHE_DIR = os.getenv("HTML_CACHE_DIR", ".html_cache")
+
+# Seconds the HTML of a legal decision is kept.
+HTML_TTL = 7 * 24 * 60 * 60
+
+# Opened on first use, see `_html_cache`.
+_html = None
+
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", ".llm_cache")
+
+# Seconds an exact-match cache entry is kept.
+RESPONSE_TTL = 30 * 24 * 60 * 60
+
+# Opened on first use, see `_response_cache`.
+_responses = None
+
+_lock = threading.Lock()
+_model = None
+# (FAISS index, SQLite connection, index file) by namespace, see `_namespace`.
+_stores = {}
+# Number of analyses stored since the index was last written, by namespace.
+_unflushed = {}
+
+def _html_cache() -> diskcache.Cache:
+    """
+    Opens the HTML cache on first use, so that importing this module creates no directories.
+    """
+    global _html
+    with _lock:
+        if _html is None:
+            _html = diskcache.Cache(HTML_CACHE_DIR)
+        return _html
+
+def _response_cache() -> diskcache.Cache:
+    """
+    Opens the exact-match cache on first use, so that importing this module creates no directories.
+    """
+    global _responses
+    with _lock:
+        if _responses is None:
+            _responses = diskcache.Cache(RESPONSE_CACHE_DIR)
+        return _responses
+
+def get_html(id: int) -> bytes | None:
+    """
+    Returns the cached raw HTML of the legal decision with the given id.
+
+    Args:
+        id (int): The id of the legal decision.
+
+    Returns:
+        bytes | None: The cached HTML, or None on a cache miss.
+    """
+    return _html_cache().get(str(id))
+
+def set_html(id: int, content: bytes):
+    """
+    Stores the raw HTML of the legal decision with the given id.
+
+    Args:
+        id (int): The id of the legal decision.
+        content (bytes): The raw HTML.
+    """
+    _html_cache().set(str(id), content, expire=HTML_TTL)
+
+def response_key(model: str, prompt_version: str, opinion_text: str) -> str:
+    """
+    Computes the exact-match cache key of an analysis.
+
+    Args:
+        model (str): The model that performs the analysis.
+        prompt_version (str): The version of the prompt used for the analysis.
+        opinion_text (str): The legal decision text.
+
+    Returns:
+        str: The cache key.
+    """
+    return hashlib.sha256((model + prompt_version + opinion_text).encode()).hexdigest()
+
+def get_response(key: str) -> str | None:
+    """
+    Returns the analysis stored in the exact-match cache under the given key.
+
+    Args:
+        key (str): The cache key, see `response_key`.
+
+    Returns:
+        str | None: The cached analysis, or None on a cache miss.
+    """
+    return _response_cache().get(key)
+
+def set_response(key: str, response: str):
+    """
+    Stores an analysis in the exact-match cache.
+
+    Args:
+        key (str): The cache key, see `response_key`.
+        response (str): The analysis to cache.
+    """
+    _response_cache().set(key, response, expire=RESPONSE_TTL)
+
+def _load_model():
+    """
+    Loads the embedding model on first use.
+    """
+    global _model
+    with _lock:
+        if _model is not None:
+            return
+
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(EMBEDDING_MODEL)
+
+def _namespace(model: str, prompt_version: str) -> str:
+    return hashlib.sha256((STORE_VERSION + model + prompt_version).encode()).hexdigest()[:16]
+
+def _load_store(model: str, prompt_version: str) -> tuple:
+    """
+    Loads the FAISS index and the SQLite table of a namespace on first use. Must be called with _lock held.
+    """
+    namespace = _namespace(model, prompt_version)
+    if namespace in _stores:
+        return _stores[namespace]
+
+    import faiss
+
+    directory = os.path.join(CACHE_DIR, namespace)
+    os.makedirs(directory, exist_ok=True)
+    index_file = os.path.join(directory, INDEX_FILE)
+    if os.path.exists(index_file):
+        index = faiss.read_index(index_file)
+    else:
+        index = faiss.IndexIDMap(faiss.IndexFlatIP(_model.get_sentence_embedding_dimension()))
+
+    db = sqlite3.connect(os.path.join(directory, DB_FILE), check_same_thread=False)
+    # Embeddings are added to the FAISS index under the ids SQLite assigns to their rows. Row ids
+    # are never reused, and each text (by its SHA-256) has a single row.
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS analyses ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, hash TEXT NOT NULL UNIQUE, length INTEGER NOT NULL, response TEXT NOT NULL)"
+    )
+    db.commit()
+
+    _stores[namespace] = (index, db, index_file)
+    _unflushed[namespace] = 0
+    return _stores[namespace]
+
+def _write_index(namespace: str):
+    """
+    Writes the FAISS index of a namespace to disk. Must be called with _lock held.
+    """
+    import faiss
+
+    index, _, index_file = _stores[namespace]
+    # Written to a temporary file first so that a crash never leaves a truncated index behind.
+    faiss.write_index(index, index_file + ".tmp")
+    os.replace(index_file + ".tmp", index_file)
+    _unflushed[namespace] = 0
+
+def embed(opinion_text: str) -> np.ndarray:
+    """
+    Embeds a legal decision text as the normalized mean of the embeddings of its windows.
+
+    Args:
+        opinion_text (str): The legal decision text.
+
+    Returns:
+        np.ndarray: A (1, d) array holding the normalized embedding.
+    """
+    _load_model()
+    windows = [opinion_text[i:i + WINDOW_CHARS] for i in range(0, max(len(opinion_text), 1), WINDOW_CHARS)]
+    vec = np.mean(_model.encode(windows, normalize_embeddings=True), axis=0, keepdims=True)
+    return np.asarray(vec / (np.linalg.norm(vec) or 1), dtype="float32")
+
+def lookup(model: str, prompt_version: str, opinion_text: str) -> str | None:
+    """
+    Returns the cached analysis of a near-duplicate of the given legal decision text.
+
+    Args:
+        model (str): The model that performs the analysis.
+        prompt_version (str): The version of the prompt used for the analysis.
+        opinion_text (str): The legal decision text.
+
+    Returns:
+        str | None: The cached analysis, or None on a cache miss.
+    """
+    vec = embed(opinion_text)
+    with _lock:
+        index, db, _ = _load_store(model, prompt_version)
+        if index.ntotal == 0:
+            return None
+
+        scores, ids = index.search(vec, 1)
+        if ids[0][0] < 0 or scores[0][0] < SIMILARITY_THRESHOLD:
+            return None
+
+        row = db.execute("SELECT length, response FROM analyses WHERE id = ?", (int(ids[0][0]),)).fetchone()
+
+    if row is None:
+        return None
+    length, response = row
+    if min(length, len(opinion_text)) < LENGTH_RATIO_THRESHOLD * max(length, len(opinion_text)):
+        return None
+    return response
+
+def store(model: str, prompt_version: str, opinion_text: str, response: str):
+    """
+    Caches the analysis of the given legal decision text.
+
+    Args:
+        model (str): The model that performed the analysis.
+        prompt_version (str): The version of the prompt used for the analysis.
+        opinion_text (str): The legal decision text.
+        response (str): The analysis to cache.
+    """
+    vec = embed(opinion_text)
+    text_hash = hashlib.sha256(opinion_text.encode()).hexdigest()
+    with _lock:
+        index, db, _ = _load_store(model, prompt_version)
+        (id,) = db.execute(
+            "INSERT INTO analyses (hash, length, response) VALUES (?, ?, ?) "
+            "ON CONFLICT (hash) DO UPDATE SET length = excluded.length, response = excluded.response RETURNING id",
+            (text_hash, len(opinion_text), response)
+        ).fetchone()
+        db.commit()
+
+        # A text analyzed again replaces its previous embedding.
+        ids = np.array([id], dtype="int64")
+        index.remove_ids(ids)
+        index.add_with_ids(vec, ids)
+
+        namespace = _namespace(model, prompt_version)
+        _unflushed[namespace] += 1
+        if _unflushed[namespace] >= FLUSH_EVERY:
+            _write_index(namespace)
+
+def flush():
+    """
+    Writes the FAISS indexes holding analyses stored since they were last written to disk.
+    """
+    with _lock:
+        for namespace, count in _unflushed.items():
+            if count:
+                _write_index(namespace)
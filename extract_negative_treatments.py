@@ -3,21 +3,40 @@
 extract_negative_treatments.py
 
 A Python module that:
-- Takes an integer id as input.
-- Constructs a URL using the id to retrieve the HTML of a legal decision.
+- Takes one or more integer ids as input.
+- Constructs a URL using each id to retrieve the HTML of a legal decision.
 - Uses the OpenAI ChatGPT SDK to prompt the LLM to find referenced cases that have been treated negatively.
 - Summarizes the results into a JSON structure.
 
+Multiple ids are fetched and analyzed concurrently. Large offline jobs can
+instead be submitted through the OpenAI Batch API and collected later.
+
 Usage:
-    python extract_negative_treatments.py <id>
+    python extract_negative_treatments.py <id> [<id> ...]
+    python extract_negative_treatments.py --batch <id> [<id> ...]
+    python extract_negative_treatments.py --poll <batch id>
 """
 
 import sys
 import os
+import re
+import html
+import orjson
+import time
+import asyncio
+import argparse
+import functools
+import aiohttp
+import httpx
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+import tiktoken
+import lxml.html
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import cache
 
 model = os.getenv("CHAT_GPT_MODEL", "gpt-3.5-turbo")
 
@@ -27,97 +46,917 @@ if openai.api_key is None:
     value = input(f"OPENAI_API_KEY is not set. Please enter your OpenAI API key: ")
     openai.api_key = value
 
-def fetch_opinion(id: int) -> str:
+# Clients shared by all OpenAI API calls so that their connection pools are reused.
+# Transient errors are retried by `retry_transient` rather than by the clients themselves.
+_CLIENT = OpenAI(
+    api_key=openai.api_key,
+    max_retries=0,
+    http_client=httpx.Client(limits=httpx.Limits(max_connections=64, max_keepalive_connections=32), http2=True, timeout=60)
+)
+_ASYNC_CLIENT = AsyncOpenAI(
+    api_key=openai.api_key,
+    max_retries=0,
+    http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=64, max_keepalive_connections=32), http2=True, timeout=60)
+)
+
+OPINION_URL = "https://scholar.google.com/scholar_case?case={id}"
+
+# Maximum number of ids that are fetched and analyzed, respectively, at the same time in bulk runs.
+MAX_CONCURRENT_FETCHES = 32
+MAX_CONCURRENT_REQUESTS = 32
+
+# Maximum number of fetched opinions waiting to be analyzed in bulk runs.
+PIPELINE_QUEUE_SIZE = 16
+
+# Maximum number of waiting opinions an analyzer takes from the queue to analyze together.
+MAX_BATCH_OPINIONS = 8
+
+# OpenAI requests and tokens per minute that concurrent analysis requests are paced to stay under.
+# Set these just below the rate limits of your account and model.
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_RPM", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TPM", "200000"))
+
+# Shared by all concurrent analysis requests.
+_REQUEST_LIMITER = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+_TOKEN_LIMITER = AsyncLimiter(TOKENS_PER_MINUTE, 60)
+
+# (connect, read) timeouts in seconds for fetching legal decisions.
+FETCH_TIMEOUT = (3, 30)
+
+# Pooled, keep-alive session shared by all synchronous fetches.
+# Transient errors are retried by `retry_transient` rather than by the adapter itself.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=64, max_retries=0))
+
+# File the Batch API requests are written to before being uploaded.
+BATCH_INPUT_FILE = "batch_input.jsonl"
+
+# Attempts and maximum wait in seconds between attempts for fetches and analysis requests that fail transiently.
+RETRY_ATTEMPTS = 5
+RETRY_MAX_WAIT = 30
+
+def _is_transient(e: BaseException) -> bool:
+    """
+    Checks whether a failed fetch or OpenAI API call is worth retrying: rate limits,
+    server errors, timeouts and connection errors are; other 4xx errors are not.
+    """
+    if isinstance(e, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (requests.ConnectionError, requests.Timeout, aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+def _retry_after(e: BaseException) -> float | None:
+    """
+    Returns the delay in seconds requested by the Retry-After header of a failed response, if any.
+    """
+    if isinstance(e, (openai.APIStatusError, requests.HTTPError)) and e.response is not None:
+        headers = e.response.headers
+    elif isinstance(e, aiohttp.ClientResponseError) and e.headers is not None:
+        headers = e.headers
+    else:
+        return None
+
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+_backoff = wait_random_exponential(min=1, max=RETRY_MAX_WAIT)
+
+def _wait(retry_state) -> float:
+    retry_after = _retry_after(retry_state.outcome.exception())
+    return min(retry_after, RETRY_MAX_WAIT) if retry_after is not None else _backoff(retry_state)
+
+# Decorator retrying fetches and analysis requests with exponential backoff and jitter, or after the
+# delay requested by the server (capped at RETRY_MAX_WAIT), and re-raising the last error once all attempts failed.
+retry_transient = retry(
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    wait=_wait,
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+
+# Seconds to wait between Batch API status checks.
+BATCH_POLL_INTERVAL = 30
+
+# Bump whenever the prompt changes so that cached analyses are invalidated.
+PROMPT_VERSION = "2"
+
+# Instructions shared by every analysis request. OpenAI caches identical prompt prefixes of at
+# least 1024 tokens, so this is kept static, above that length, and first in the input.
+SYSTEM_PROMPT = (
+    "You are a helpful lawyer and an expert legal analyst. "
+    "\n\n"
+    "TASK\n"
+    "The user message contains the texts of one or more legal opinions that reference other cases, each preceded by a '---OPINION <n>---' delimiter, where <n> starts at 0. "
+    "Analyze each opinion independently. "
+    "Identify any of the referenced cases that are treated negatively in each opinion. "
+    "DO NOT CONSIDER AN OPINION ITSELF AS A REFERENCED CASE AND DO NOT RETURN IT IN THE RESULTS. "
+    "For each of such cases, determine the nature of the treatment, quote the text of the negative treatment, and give an explanation of why the treatment was determined to be negative. "
+    "\n\n"
+    "DEFINITION\n"
+    "A case is treated negatively if the opinion expresses disapproval or disagreement with the case, or ignores it as precedent. "
+    "Treatment is judged from the perspective of the court writing the opinion, not from the perspective of the parties, the dissent or the lower court. "
+    "Arguments of the parties that the court merely restates, without adopting them, are not treatments by the court. "
+    "Statements in a dissenting or concurring opinion are only negative treatments if the court's opinion adopts them. "
+    "\n\n"
+    "RUBRIC\n"
+    "Use the following categories for the 'nature' of a negative treatment, choosing the most specific one that applies:\n"
+    "- Overruled: the court, having the authority to do so, expressly holds that the referenced case is no longer good law, in whole or in part. "
+    "Typical language includes 'we overrule', 'is hereby overruled', 'to the extent that it holds otherwise, it is overruled' and 'is no longer the law of this state'.\n"
+    "- Abrogated or superseded: the court recognizes that the referenced case has been displaced by a later statute, rule, constitutional amendment or decision of a higher court. "
+    "Typical language includes 'was abrogated by', 'has been superseded by statute' and 'in light of the amendment, no longer controls'.\n"
+    "- Disapproved: the court expresses disapproval of the reasoning or the holding of the referenced case without formally overruling it, often because it is a decision of a lower or coordinate court. "
+    "Typical language includes 'we disapprove', 'to the extent it suggests otherwise, we disapprove of it' and 'was wrongly decided'.\n"
+    "- Declined to follow: the court refuses to apply the referenced case, typically a decision from another jurisdiction or a persuasive authority. "
+    "Typical language includes 'we decline to follow', 'we are not persuaded by', 'we reject the reasoning of' and 'we choose not to adopt the rule of'.\n"
+    "- Criticized: the court questions the soundness of the referenced case or notes that it has been widely criticized, without refusing to follow it outright. "
+    "Typical language includes 'has been the subject of criticism', 'its reasoning is questionable' and 'we have doubts about'.\n"
+    "- Limited: the court restricts the referenced case to its facts or narrows its holding so that it no longer applies broadly. "
+    "Typical language includes 'is limited to its facts', 'should be read narrowly' and 'does not extend beyond'.\n"
+    "- Conflict recognized: the court acknowledges that its holding conflicts with the referenced case. "
+    "Typical language includes 'we recognize conflict with', 'we certify conflict with' and 'cannot be reconciled with'.\n"
+    "- Ignored as precedent: the court acknowledges the referenced case as relevant authority but reaches a contrary result without following or distinguishing it.\n"
+    "\n"
+    "The following are NOT negative treatments and must not be returned:\n"
+    "- Distinguishing a case on its facts while accepting its rule of law.\n"
+    "- Following, applying, citing or quoting a case with approval.\n"
+    "- Citing a case for a general proposition, in a string citation, or in a 'see' or 'cf.' signal.\n"
+    "- Describing the procedural history of the case being decided, including reversing or affirming the decision under review.\n"
+    "- Noting that a referenced case was decided under a different statute or rule without expressing disapproval of it.\n"
+    "\n\n"
+    "OUTPUT\n"
+    "Each negatively-treated case is a JSON object with the following keys: ['caseName', 'jurisdiction', 'citation', 'nature', 'quotedText', 'explanation']. "
+    "'caseName' is the name of the referenced case as it appears in the opinion, for example 'Smith v. Jones'. "
+    "'jurisdiction' is the court or state of the referenced case, if it can be determined from the opinion, and otherwise null. "
+    "'citation' is the reporter citation of the referenced case as it appears in the opinion, for example '123 So. 2d 456 (Fla. 1960)', and otherwise null. "
+    "'nature' is one of the rubric categories above. "
+    "'quotedText' is the exact text of the opinion that expresses the negative treatment, quoted verbatim and without ellipses where possible. "
+    "'explanation' is one or two sentences explaining why the quoted text is a negative treatment of the referenced case. "
+    "Return each negatively-treated case only once per opinion, even if it is treated negatively in several places; quote the most explicit passage. "
+    "If there are no cases treated negatively in an opinion, its list is EXACTLY '[]'. "
+    'Return a JSON object {"results": [[...cases for opinion 0...], [...cases for opinion 1...]]} with one list per opinion, in order. '
+    "Return exactly as many lists as there are opinions. "
+    "You will NOT wrap the response with JSON md markers. "
+    "Your response will consist ONLY of the JSON object, with no additional commentary."
+)
+
+# The system messages are identical for every request and are shared rather than rebuilt per call.
+_SYSTEM_MSGS = [{"role": "system", "content": SYSTEM_PROMPT}]
+
+# Templates of the user message and of each opinion in it.
+PROMPT_TEMPLATE = "Legal Opinion Texts:\n{opinions}"
+OPINION_TEMPLATE = "\n---OPINION {index}---\n{opinion}\n"
+
+# Opinions longer than this many tokens are split into chunks that are analyzed separately.
+MAX_INPUT_TOKENS = 12000
+
+# Output token budget per analyzed opinion (or chunk); lists of negatively-treated cases are short.
+MAX_OUTPUT_TOKENS = 2048
+
+# Limits of a single request for gpt-3.5-turbo: its context window (input and output tokens together)
+# and its maximum number of output tokens. Opinions are packed into requests within both; raise them
+# for models with larger limits.
+MAX_REQUEST_TOKENS = 16385
+MAX_REQUEST_OUTPUT_TOKENS = 4096
+
+# Number of tokens at the end of a chunk that are repeated at the start of the next one.
+CHUNK_OVERLAP_TOKENS = 200
+
+# Id of the element holding the opinion on a Scholar page; navigation and other page chrome is skipped.
+OPINION_CONTAINER_ID = "gs_opinion"
+
+# Legal decision HTML is decoded as UTF-8, like in `fast_text`, rather than guessed by lxml.
+_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+# Patterns used by `fast_text` to extract visible text without building a parse tree.
+_SCRIPT = re.compile(rb"<(script|style)\b[^>]*>.*?</\1>", re.S | re.I)
+_TAG = re.compile(rb"<[^>]+>")
+_SPACES = re.compile(r"[^\S\n]+")
+_NEWLINES = re.compile(r"\s*\n\s*")
+
+# Language that signals a possible negative treatment. Opinions (or chunks) without any of it
+# are not sent to the model, so this errs on the side of matching too much. Words of a phrase
+# are separated by any whitespace, since extracted text puts every text node on its own line.
+_NEG_RE = re.compile(
+    r"\b(overrul\w*|disapprov\w*|abrogat\w*|supersed\w*|reced\w*|criticiz\w*|disagree\w*"
+    r"|declin\w*\s+to\s+(follow|adopt|extend|apply)|reject\w*\s+the\s+(reasoning|rule|holding)"
+    r"|not\s+persuasive|wrongly\s+decided|no\s+longer\s+(good\s+law|the\s+law|controls?)|limited\s+to\s+its\s+facts"
+    r"|cannot\s+be\s+reconciled|conflict\s+with|to\s+the\s+contrary|contrary\s+(authority|holding|to))\b",
+    re.I
+)
+
+# Case names are compared without case, punctuation or spacing when merging the results of chunks.
+_CASE_NAME_NOISE = re.compile(r"[^a-z0-9]+")
+
+@functools.cache
+def get_encoding() -> tiktoken.Encoding:
+    """
+    Loads the tokenizer of the model on first use. tiktoken downloads it (once) the first time,
+    so it is not loaded at import.
+    
+    Returns:
+        tiktoken.Encoding: The tokenizer.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of a text for the model.
+    
+    Args:
+        text (str): The text.
+    
+    Returns:
+        int: The number of tokens.
+    """
+    return len(get_encoding().encode(text))
+
+@functools.cache
+def request_overhead_tokens() -> int:
+    """
+    Returns the tokens every request spends on the system prompt and the user prompt, besides the opinion texts.
+    """
+    return count_tokens(SYSTEM_PROMPT) + count_tokens(PROMPT_TEMPLATE.format(opinions=""))
+
+@functools.cache
+def opinion_overhead_tokens() -> int:
+    """
+    Returns the tokens a request spends on the delimiter of each opinion, besides its text.
+    """
+    return count_tokens(OPINION_TEMPLATE.format(index=0, opinion=""))
+
+def fast_text(content: bytes) -> str:
+    """
+    Extracts the visible text content from HTML with regular expressions, one line per text node.
+    
+    Args:
+        content (bytes): The raw HTML.
+    
+    Returns:
+        str: The extracted text.
+    """
+    content = _SCRIPT.sub(b"", content)
+    content = _TAG.sub(b"\n", content)
+    text = html.unescape(content.decode("utf-8", errors="replace"))
+    text = _SPACES.sub(" ", text)
+    return _NEWLINES.sub("\n", text).strip()
+
+def has_negative_signal(opinion_text: str) -> bool:
+    """
+    Checks whether a legal decision text contains language that may signal a negative treatment.
+    
+    Args:
+        opinion_text (str): The legal decision text.
+    
+    Returns:
+        bool: False if the text certainly needs no analysis by the model.
+    """
+    return _NEG_RE.search(opinion_text) is not None
+
+def extract_opinion_text(content: bytes) -> str:
+    """
+    Extracts the visible text content from legal decision HTML.
+    
+    Args:
+        content (bytes): The raw HTML of the legal decision.
+    
+    Returns:
+        str: The extracted legal decision text.
+    """
+    # Pages without an opinion container (e.g. saved from other sources) fall back to all
+    # visible text, which does not need a parse tree.
+    if OPINION_CONTAINER_ID.encode() not in content:
+        return fast_text(content)
+
+    # Parse the HTML with lxml and extract the visible text of the opinion container in C.
+    opinion = lxml.html.fromstring(content, parser=_HTML_PARSER).get_element_by_id(OPINION_CONTAINER_ID, None)
+    if opinion is None:
+        return fast_text(content)
+
+    for element in list(opinion.iter("script", "style")):
+        element.drop_tree()
+
+    # Text nodes are kept on separate lines so that paragraphs are not run together.
+    text = "\n".join(opinion.itertext())
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+@retry_transient
+def fetch_opinion(id: int, use_cache: bool = True) -> str:
     """
     Fetches and returns the text content from the legal decision HTML with the given id.
     
     Args:
         id (int): The id to be passed into the query.
+        use_cache (bool): Whether previously fetched HTML may be reused instead of fetching it again.
     
     Returns:
         str: The extracted legal decision text.
     """
-    url = f"https://scholar.google.com/scholar_case?case={id}"
-    response = requests.get(url)
-    response.raise_for_status()
+    content = cache.get_html(id) if use_cache else None
+    if content is None:
+        url = OPINION_URL.format(id=id)
+        response = SESSION.get(url, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        content = response.content
+        cache.set_html(id, content)
+    return extract_opinion_text(content)
 
-    # Parse the HTML using BeautifulSoup to extract visible text.
-    soup = BeautifulSoup(response.content, 'html.parser')
+@retry_transient
+async def afetch_opinion(id: int, session: aiohttp.ClientSession, use_cache: bool = True) -> str:
+    """
+    Asynchronously fetches and returns the text content from the legal decision HTML with the given id.
+    
+    Args:
+        id (int): The id to be passed into the query.
+        session (aiohttp.ClientSession): The session used to make the request.
+        use_cache (bool): Whether previously fetched HTML may be reused instead of fetching it again.
     
-    # You can customize the extraction according to the structure of the page.
-    # For now, we'll simply extract all text.
-    opinion_text = soup.get_text(separator="\n", strip=True)
-    return opinion_text
+    Returns:
+        str: The extracted legal decision text.
+    """
+    # Cache access and parsing block, so they run in threads to keep the event loop free for
+    # the other fetches and the analysis requests.
+    content = await asyncio.to_thread(cache.get_html, id) if use_cache else None
+    if content is None:
+        url = OPINION_URL.format(id=id)
+        async with session.get(url) as response:
+            response.raise_for_status()
+            content = await response.read()
+        await asyncio.to_thread(cache.set_html, id, content)
+    return await asyncio.to_thread(extract_opinion_text, content)
 
-def get_negative_treatments(opinion_text: str) -> str:
+def split_opinion(opinion_text: str, max_tokens: int = MAX_INPUT_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[str]:
     """
-    Uses the OpenAI ChatGPT API to analyze a legal decision text and extract
-    a list of referenced cases that have been treated negatively.
+    Splits the legal decision text at paragraph boundaries into overlapping chunks
+    of at most max_tokens tokens.
     
     Args:
         opinion_text (str): The legal decision text.
+        max_tokens (int): The maximum number of tokens in a chunk.
+        overlap_tokens (int): The number of tokens repeated between consecutive chunks.
+    
+    Returns:
+        list[str]: The chunks, or just the legal decision text if it is short enough.
+    """
+    if count_tokens(opinion_text) <= max_tokens:
+        return [opinion_text]
+
+    encoding = get_encoding()
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in opinion_text.split("\n"):
+        tokens = encoding.encode(paragraph)
+        # Paragraphs that cannot fit in a chunk with the overlap are split at token boundaries.
+        step = max_tokens - overlap_tokens - 1
+        for start in range(0, max(len(tokens), 1), step):
+            piece = tokens[start:start + step]
+            # Each piece also costs the newline that joins it to the previous one.
+            if current and current_tokens + len(piece) + 1 > max_tokens:
+                chunks.append("\n".join(encoding.decode(p) for p in current))
+
+                # Carry the trailing overlap_tokens tokens over so treatments spanning the boundary
+                # are not lost, slicing the earliest piece carried over if it does not fit whole.
+                overlap = []
+                overlap_count = 0
+                for p in reversed(current):
+                    room = overlap_tokens - overlap_count - 1
+                    if room <= 0:
+                        break
+                    p = p[-room:]
+                    overlap.insert(0, p)
+                    overlap_count += len(p) + 1
+                current, current_tokens = overlap, overlap_count
+
+            current.append(piece)
+            current_tokens += len(piece) + 1
+
+    chunks.append("\n".join(encoding.decode(p) for p in current))
+    return chunks
+
+def merge_treatments(treatments: list[list[dict]]) -> list[dict]:
+    """
+    Merges the lists of negatively-treated cases found in the chunks of a legal decision.
+    
+    Args:
+        treatments (list[list[dict]]): The negatively-treated cases of each chunk.
+    
+    Returns:
+        list[dict]: The negatively-treated cases, without cases repeated across chunks.
+    """
+    # A case found in several chunks may be named slightly differently, or cited in only some of them,
+    # so cases are matched by their normalized name and the entry with a citation is kept.
+    merged = {}
+    for t in treatments:
+        for case in t:
+            # Cases without a name cannot be matched and are all kept.
+            key = _CASE_NAME_NOISE.sub(" ", (case.get("caseName") or "").lower()).strip() or id(case)
+            if key not in merged or (not merged[key].get("citation") and case.get("citation")):
+                merged[key] = case
+    return list(merged.values())
+
+def build_request(opinions: list[str]) -> dict:
+    """
+    Builds the arguments of the OpenAI Responses API call that analyzes the given legal decision texts.
+    
+    Args:
+        opinions (list[str]): The legal decision texts, each short enough to fit in a prompt (see `split_opinion`).
     
     Returns:
-        str: A JSON list of information on cases that have negative treatment.
-    """
-    # Prepare the prompt for the ChatGPT model.
-    prompt = (
-        "You are an expert legal analyst."
-        "A case is treated negatively if the opinion expresses disapproval or disagreement with the case, or ignores it as precedent."
-        "Below is the text of a legal opinion that references other cases."
-        "DO NOT CONSIDER THE OPINION ITSELF AS A REFERENCED CASE AND DO NOT RETURN IT IN THE RESULTS."
-        "Identify any of the referenced cases that are treated negatively in the opinion."
-        "For each of such cases, determine the nature of the treatment, quote the text of the negative treatment, and give an explanation of why the treatment was determined to be negative."
-        "If there are cases that are treated negatively, return a JSON encoded list where each negatively-treated case is a JSON object with the following keys: ['caseName', 'jurisdiction', 'citation', 'nature', 'quotedText', 'explanation']."
-        "If there are no cases treated negatively, respond EXACTLY with '[]'."
-        "\n"
-        f"Legal Opinion Text:\n{opinion_text}\n"
+        dict: The keyword arguments for `responses.create`.
+    """
+    opinions_text = "".join(
+        OPINION_TEMPLATE.format(index=i, opinion=opinion_text)
+        for i, opinion_text in enumerate(opinions)
     )
 
+    # Only the opinion texts vary between calls; they go last so the system prompt stays a cacheable prefix.
+    return dict(
+        model=model,
+        input=[*_SYSTEM_MSGS, {"role": "user", "content": PROMPT_TEMPLATE.format(opinions=opinions_text)}],
+        temperature=0,
+        top_p=1,
+        max_output_tokens=MAX_OUTPUT_TOKENS * len(opinions)
+    )
+
+def count_request_tokens(opinions: list[str]) -> int:
+    """
+    Estimates the tokens an analysis request counts against the rate limit: its input
+    tokens plus the maximum number of output tokens.
+    
+    Args:
+        opinions (list[str]): The legal decision texts analyzed by the request.
+    
+    Returns:
+        int: The estimated number of tokens.
+    """
+    input_tokens = request_overhead_tokens() + sum(
+        count_tokens(opinion_text) + opinion_overhead_tokens() for opinion_text in opinions
+    )
+    return input_tokens + MAX_OUTPUT_TOKENS * len(opinions)
+
+def pack_requests(opinions: list[str]) -> list[list[int]]:
+    """
+    Packs legal decision texts into analysis requests, in order, so that each request stays
+    within the context window and the output limit of the model (see `MAX_REQUEST_TOKENS`
+    and `MAX_REQUEST_OUTPUT_TOKENS`).
+    
+    Args:
+        opinions (list[str]): The legal decision texts, each short enough to fit in a prompt (see `split_opinion`).
+    
+    Returns:
+        list[list[int]]: For each request, the indices of the opinions it analyzes.
+    """
+    packed = []
+    indices, total_tokens = [], request_overhead_tokens()
+    for i, opinion_text in enumerate(opinions):
+        tokens = count_tokens(opinion_text) + opinion_overhead_tokens() + MAX_OUTPUT_TOKENS
+        fits = (
+            total_tokens + tokens <= MAX_REQUEST_TOKENS
+            and MAX_OUTPUT_TOKENS * (len(indices) + 1) <= MAX_REQUEST_OUTPUT_TOKENS
+        )
+        # An opinion that does not fit starts a new request, even if it exceeds the limits on its own.
+        if indices and not fits:
+            packed.append(indices)
+            indices, total_tokens = [], request_overhead_tokens()
+        indices.append(i)
+        total_tokens += tokens
+
+    if indices:
+        packed.append(indices)
+    return packed
+
+def log_usage(response):
+    """
+    Prints how many of the input tokens of a Responses API call were served from OpenAI's prompt cache.
+    
+    Args:
+        response: The response returned by `responses.create`.
+    """
+    usage = response.usage
+    if usage is None:
+        return
+    details = usage.input_tokens_details
+    cached_tokens = details.cached_tokens if details is not None else 0
+    print(f"Input tokens: {usage.input_tokens} ({cached_tokens} cached)")
+
+def parse_results(output_text: str, count: int) -> list[list[dict]]:
+    """
+    Parses the model output of a (batched) analysis request.
+    
+    Args:
+        output_text (str): The text returned by the model.
+        count (int): The number of opinions that were analyzed.
+    
+    Returns:
+        list[list[dict]]: For each opinion (in order), a list of information on cases that have negative treatment.
+    
+    Raises:
+        ValueError: If the output is not in the expected form.
+    """
+    try:
+        results = orjson.loads(output_text)["results"]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"missing 'results' list: {e}") from e
+
+    if not isinstance(results, list) or len(results) != count:
+        raise ValueError(f"expected {count} result lists")
+
+    if not all(isinstance(t, list) and all(isinstance(case, dict) for case in t) for t in results):
+        raise ValueError("expected each result to be a list of objects")
+
+    return results
+
+def get_cached_treatments(opinion_text: str) -> str | None:
+    """
+    Returns the cached analysis of a legal decision text, checking the exact-match
+    cache first and the semantic cache second.
+    
+    Args:
+        opinion_text (str): The legal decision text.
+    
+    Returns:
+        str | None: The cached JSON list of cases that have negative treatment, or None on a cache
+        miss or if the caches cannot be read.
+    """
+    try:
+        cached = cache.get_response(cache.response_key(model, PROMPT_VERSION, opinion_text))
+        if cached is None:
+            cached = cache.lookup(model, PROMPT_VERSION, opinion_text)
+    except Exception as e:
+        print(f"Error reading cached analysis: {e}", file=sys.stderr)
+        return None
+    return cached
+
+def cache_treatments(opinion_text: str, treatments: str):
+    """
+    Stores the analysis of a legal decision text in the exact-match and semantic caches.
+    
+    Caching is best-effort: errors are reported and do not fail the analysis.
+    
+    Args:
+        opinion_text (str): The legal decision text.
+        treatments (str): The JSON list of cases that have negative treatment.
+    """
+    try:
+        cache.set_response(cache.response_key(model, PROMPT_VERSION, opinion_text), treatments)
+        cache.store(model, PROMPT_VERSION, opinion_text, treatments)
+    except Exception as e:
+        print(f"Error caching analysis: {e}", file=sys.stderr)
+
+@retry_transient
+async def acreate_response(opinions: list[str], client: AsyncOpenAI):
+    """
+    Asynchronously calls the OpenAI Responses API to analyze the given legal decision texts,
+    pacing the call under the rate limits and retrying transient errors.
+    
+    Args:
+        opinions (list[str]): The legal decision texts, each short enough to fit in a prompt.
+        client (AsyncOpenAI): The client used to call the API.
+    
+    Returns:
+        The response returned by `responses.create`.
+    """
+    # Wait for both a request slot and enough token budget, so concurrent calls stay under the rate limits.
+    async with _REQUEST_LIMITER:
+        await _TOKEN_LIMITER.acquire(min(count_request_tokens(opinions), TOKENS_PER_MINUTE))
+        return await client.responses.create(**build_request(opinions))
+
+async def arequest_treatments(opinions: list[str], client: AsyncOpenAI) -> list[list[dict]]:
+    """
+    Asynchronously sends one batched analysis request for the given legal decision texts.
+    
+    Args:
+        opinions (list[str]): The legal decision texts, each short enough to fit in a prompt.
+        client (AsyncOpenAI): The client used to call the API.
+    
+    Returns:
+        list[list[dict]]: For each opinion (in order), a list of information on cases that have negative treatment.
+    """
+    response = await acreate_response(opinions, client)
+    log_usage(response)
+    return parse_results(response.output_text, len(opinions))
+
+async def aget_negative_treatments(opinions: list[str], client: AsyncOpenAI) -> list[list[dict] | Exception]:
+    """
+    Asynchronously uses the OpenAI ChatGPT API to analyze one or more legal decision texts,
+    several of them per request, and extract, for each of them, a list of referenced cases
+    that have been treated negatively.
+    
+    A failed request only fails the opinions whose chunks it analyzed; the others are still
+    returned and cached.
+    
+    Args:
+        opinions (list[str]): The legal decision texts.
+        client (AsyncOpenAI): The client used to call the API.
+    
+    Returns:
+        list[list[dict] | Exception]: For each opinion (in order), a list of information on cases that
+        have negative treatment, or the error of a request that analyzed one of its chunks.
+    """
+    # Opinions without any negative treatment language need no analysis, and the analysis of
+    # near-duplicate opinions is reused; only the others are sent to the model.
+    results = [None if has_negative_signal(opinion_text) else [] for opinion_text in opinions]
+    candidates = [i for i, r in enumerate(results) if r is None]
+
+    # Embedding the opinions is CPU-bound, so keep it off the event loop.
+    cached = await asyncio.gather(*[asyncio.to_thread(get_cached_treatments, opinions[i]) for i in candidates])
+    misses = []
+    for i, c in zip(candidates, cached):
+        if c is None:
+            misses.append(i)
+        else:
+            results[i] = orjson.loads(c)
+
+    # Long opinions are split into chunks. The chunks of all opinions are packed into requests within
+    # the model's token limits, the requests are sent concurrently, and the results of each opinion's
+    # chunks are merged back together.
+    chunks = [(i, chunk) for i in misses for chunk in split_opinion(opinions[i]) if has_negative_signal(chunk)]
+    batches = [[chunks[k] for k in indices] for indices in pack_requests([chunk for _, chunk in chunks])]
+    responses = await asyncio.gather(
+        *[arequest_treatments([chunk for _, chunk in batch], client) for batch in batches],
+        return_exceptions=True
+    )
+
+    found = {i: [] for i in misses}
+    errors = {}
+    for batch, treatments in zip(batches, responses):
+        if isinstance(treatments, Exception):
+            for i, _ in batch:
+                errors.setdefault(i, treatments)
+            continue
+        for (i, _), t in zip(batch, treatments):
+            found[i].append(t)
+
+    analyzed = [i for i in misses if i not in errors]
+    for i in misses:
+        results[i] = errors[i] if i in errors else merge_treatments(found[i])
+    await asyncio.gather(*[
+        asyncio.to_thread(cache_treatments, opinions[i], orjson.dumps(results[i]).decode())
+        for i in analyzed
+    ])
+    return results
+
+async def process_ids(ids: list[int], use_cache: bool = True) -> dict[int, list[dict]]:
+    """
+    Concurrently fetches and analyzes the legal decisions with the given ids.
+    
+    Ids that fail to be fetched or analyzed are reported and left out of the results.
+    
+    Args:
+        ids (list[int]): The ids of the legal decisions.
+        use_cache (bool): Whether previously fetched HTML may be reused instead of fetching it again.
+    
+    Returns:
+        dict[int, list[dict]]: For each successfully processed id, a list of information on cases that have negative treatment.
+    """
+    # Fetching and analysis are pipelined: fetchers feed opinions into the queue while
+    # analyzers work on the ones already fetched, so network and model latencies overlap.
+    queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    pending = iter(ids)
+    results = {}
+
+    async def fetcher():
+        for id in pending:
+            try:
+                print(f"Fetching legal decision text with id: {id}")
+                opinion_text = await afetch_opinion(id, session, use_cache)
+            except Exception as e:
+                print(f"Error processing id {id}: {e}", file=sys.stderr)
+                continue
+            await queue.put((id, opinion_text))
+
+    async def analyzer():
+        done = False
+        while not done and (item := await queue.get()) is not None:
+            # Opinions already waiting in the queue are analyzed together so that they can share requests.
+            batch = [item]
+            while len(batch) < MAX_BATCH_OPINIONS:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+
+            batch_ids = [id for id, _ in batch]
+            try:
+                print(f"Analyzing legal decision(s) {', '.join(map(str, batch_ids))} for negative case treatment using ChatGPT...")
+                treatments = await aget_negative_treatments([opinion_text for _, opinion_text in batch], _ASYNC_CLIENT)
+            except Exception as e:
+                for id in batch_ids:
+                    print(f"Error processing id {id}: {e}", file=sys.stderr)
+                continue
+
+            for id, t in zip(batch_ids, treatments):
+                if isinstance(t, Exception):
+                    print(f"Error processing id {id}: {t}", file=sys.stderr)
+                else:
+                    results[id] = t
+
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=32, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(sock_connect=FETCH_TIMEOUT[0], sock_read=FETCH_TIMEOUT[1])
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        analyzers = [asyncio.create_task(analyzer()) for _ in range(min(MAX_CONCURRENT_REQUESTS, len(ids)))]
+        await asyncio.gather(*[fetcher() for _ in range(min(MAX_CONCURRENT_FETCHES, len(ids)))])
+
+        # One sentinel per analyzer signals that no more opinions are coming.
+        for _ in analyzers:
+            await queue.put(None)
+        await asyncio.gather(*analyzers)
+
+    # Analyses cached during the run are only written to the semantic cache's index periodically.
+    try:
+        await asyncio.to_thread(cache.flush)
+    except Exception as e:
+        print(f"Error caching analyses: {e}", file=sys.stderr)
+
+    return {id: results[id] for id in ids if id in results}
+
+def submit_batch(ids: list[int], use_cache: bool = True) -> str:
+    """
+    Fetches the legal decisions with the given ids and submits their analysis
+    as an OpenAI Batch API job.
+    
+    Ids that fail to be fetched are reported and left out of the batch.
+    
+    Args:
+        ids (list[int]): The ids of the legal decisions.
+        use_cache (bool): Whether previously fetched HTML may be reused instead of fetching it again.
+    
+    Returns:
+        str: The id of the created batch.
+    """
+    requests_count = 0
+    with open(BATCH_INPUT_FILE, "wb") as f:
+        for id in ids:
+            try:
+                print(f"Fetching legal decision text with id: {id}")
+                opinion_text = fetch_opinion(id, use_cache)
+            except Exception as e:
+                print(f"Error processing id {id}: {e}", file=sys.stderr)
+                continue
+
+            # Chunks of long opinions are tagged "<id>#<n>" and merged back together by `poll_batch`.
+            # Chunks without negative treatment language are left out of the batch.
+            chunks = split_opinion(opinion_text)
+            for n, chunk in enumerate(chunks):
+                if not has_negative_signal(chunk):
+                    continue
+
+                requests_count += 1
+                line = {
+                    "custom_id": str(id) if len(chunks) == 1 else f"{id}#{n}",
+                    "method": "POST",
+                    "url": "/v1/responses",
+                    "body": build_request([chunk]),
+                }
+                f.write(orjson.dumps(line) + b"\n")
+
+    if requests_count == 0:
+        sys.exit("Nothing to submit: no fetched legal decision contains negative treatment language.")
+
     try:
-        client = OpenAI()
-
-        response = client.responses.create(
-            model=model,
-            input=[
-                {"role": "system", "content": "You are a helpful lawyer."},
-                {"role": "system", "content": "Your response will consist ONLY of a list."},
-                {"role": "system", "content": "You will NOT wrap the response with JSON md markers."},
-                {"role": "system", "content": "The response JSON will have NO top-level keys."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1,
-            top_p=1
+        with open(BATCH_INPUT_FILE, "rb") as f:
+            input_file = _CLIENT.files.create(file=f, purpose="batch")
+
+        batch = _CLIENT.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/responses",
+            completion_window="24h"
         )
     except Exception as e:
         sys.exit(f"Error calling OpenAI API: {e}")
 
-    return response.output_text
+    return batch.id
 
-def main(id: int):
-    print(f"Fetching legal decision text with id: {id}")
-    opinion_text = fetch_opinion(id)
+def response_output_text(body: dict) -> str:
+    """
+    Collects the output text of a raw Responses API response body, as returned
+    in Batch API output files.
+    
+    Args:
+        body (dict): The response body.
     
-    print("Analyzing legal decision for negative case treatment using ChatGPT...")
-    treatments = get_negative_treatments(opinion_text)
+    Returns:
+        str: The concatenated output text.
+    """
+    return "".join(
+        content["text"]
+        for item in body.get("output", [])
+        if item.get("type") == "message"
+        for content in item.get("content", [])
+        if content.get("type") == "output_text"
+    )
 
-    if treatments == "[]":
+def poll_batch(batch_id: str) -> dict[str, list[dict]]:
+    """
+    Waits for an OpenAI Batch API job to complete and parses its output.
+    
+    Requests that failed or returned malformed output are reported and left out of the results.
+    
+    Args:
+        batch_id (str): The id of the batch.
+    
+    Returns:
+        dict[str, list[dict]]: For each successfully processed id, a list of information on cases that have negative treatment.
+    """
+    try:
+        batch = _CLIENT.batches.retrieve(batch_id)
+        while batch.status != "completed":
+            if batch.status in ("failed", "expired", "cancelling", "cancelled"):
+                sys.exit(f"Batch {batch_id} did not complete: {batch.status}")
+
+            print(f"Batch {batch_id} is {batch.status}, checking again in {BATCH_POLL_INTERVAL}s...")
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = _CLIENT.batches.retrieve(batch_id)
+
+        # Successful requests are written to the output file and failed ones to the error file;
+        # a batch in which all requests failed has no output file, and vice versa.
+        output = _CLIENT.files.content(batch.output_file_id).text if batch.output_file_id else ""
+        errors = _CLIENT.files.content(batch.error_file_id).text if batch.error_file_id else ""
+    except openai.OpenAIError as e:
+        sys.exit(f"Error calling OpenAI API: {e}")
+
+    chunk_results = {}
+    failed = set()
+    for line in [*output.splitlines(), *errors.splitlines()]:
+        if not line.strip():
+            continue
+
+        record = orjson.loads(line)
+        id = record["custom_id"].split("#")[0]
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            print(f"Error processing id {id}: {record.get('error') or response.get('body')}", file=sys.stderr)
+            failed.add(id)
+            continue
+
+        try:
+            chunk_results.setdefault(id, []).append(parse_results(response_output_text(response["body"]), 1)[0])
+        except ValueError as e:
+            print(f"Error processing id {id}: {e}", file=sys.stderr)
+            failed.add(id)
+
+    if failed:
+        print(f"Failed to process id(s): {', '.join(sorted(failed))}", file=sys.stderr)
+
+    # An id is only reported if all of its chunks succeeded.
+    results = {id: merge_treatments(t) for id, t in chunk_results.items() if id not in failed}
+    if not results and failed:
+        sys.exit(f"Batch {batch_id} has no successful requests.")
+    return results
+
+def write_results(treatments: list[dict] | dict[int, list[dict]]):
+    if not treatments:
         print("NO NEGATIVELY-TREATED CASES FOUND!")
-        f.write("")
+        with open("results.json", "w") as f:
+            f.write("")
         return
     else:
+        output = orjson.dumps(treatments, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
         with open("results.json", "w") as f:
-            f.write(treatments)
+            f.write(output)
 
         print("\nFOUND NEGATIVELY-TREATED CASE(S) (see 'results.json'):")
-        print(treatments)
+        print(output)
         return
 
+def main(ids: list[int], use_cache: bool = True):
+    results = asyncio.run(process_ids(ids, use_cache))
+    if not results:
+        sys.exit("Failed to process any ids.")
+
+    # A single id keeps the original output: a plain list of cases.
+    treatments = results[ids[0]] if len(ids) == 1 else {id: t for id, t in results.items() if t}
+    write_results(treatments)
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python extract_negative_treatments.py <id>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Extract negatively-treated cases from legal decisions.")
+    parser.add_argument("ids", nargs="*", type=int, help="ids of the legal decisions to analyze")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--batch", action="store_true", help="submit the ids as an OpenAI Batch API job instead of analyzing them now")
+    mode.add_argument("--poll", metavar="BATCH_ID", help="wait for a submitted batch to complete and collect its results")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="fetch the legal decisions again instead of using previously fetched HTML")
+    args = parser.parse_args()
 
-    id = sys.argv[1]
-    main(id)
+    if args.poll:
+        results = poll_batch(args.poll)
+        write_results({id: t for id, t in results.items() if t})
+    elif not args.ids:
+        parser.error("at least one id is required")
+    elif args.batch:
+        batch_id = submit_batch(args.ids, args.use_cache)
+        print(f"Submitted batch {batch_id}; collect the results with --poll {batch_id}")
+    else:
+        main(args.ids, args.use_cache)
@@ -0,0 +1,98 @@
+import os
+import unittest
+
+# Importing the module prompts for an API key when none is set.
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from extract_negative_treatments import (
+    MAX_OUTPUT_TOKENS,
+    MAX_REQUEST_OUTPUT_TOKENS,
+    MAX_REQUEST_TOKENS,
+    count_request_tokens,
+    extract_opinion_text,
+    fast_text,
+    get_encoding,
+    has_negative_signal,
+    merge_treatments,
+    pack_requests,
+    split_opinion,
+)
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "test_data")
+
+def _encoding_available() -> bool:
+    try:
+        get_encoding()
+    except Exception:
+        return False
+    return True
+
+# tiktoken downloads the encoding the first time it is used, so tests counting tokens need network access once.
+requires_encoding = unittest.skipUnless(_encoding_available(), "the tiktoken encoding could not be loaded")
+
+class HasNegativeSignalTest(unittest.TestCase):
+    def test_phrase_split_by_inline_tags(self):
+        text = fast_text(b"<p>we <em>decline</em> to follow <i>Smith</i></p>")
+        self.assertTrue(has_negative_signal(text))
+
+    def test_phrase_wrapped_across_lines(self):
+        text = fast_text(b"<p>We reject the\nreasoning of Doe.</p>")
+        self.assertTrue(has_negative_signal(text))
+
+    def test_phrase_split_in_opinion_container(self):
+        content = b'<html><body><div id="gs_opinion"><p>That rule is <b>no</b>\nlonger good law.</p></div></body></html>'
+        self.assertTrue(has_negative_signal(extract_opinion_text(content)))
+
+    def test_no_signal(self):
+        text = fast_text(b"<p>The judgment is affirmed. See <i>Smith v. Jones</i>.</p>")
+        self.assertFalse(has_negative_signal(text))
+
+    def test_test_data(self):
+        with open(os.path.join(TEST_DATA, "little.html"), "rb") as f:
+            self.assertTrue(has_negative_signal(extract_opinion_text(f.read())))
+        with open(os.path.join(TEST_DATA, "john-v-state-7.html"), "rb") as f:
+            self.assertFalse(has_negative_signal(extract_opinion_text(f.read())))
+
+@requires_encoding
+class SplitOpinionTest(unittest.TestCase):
+    def test_short_opinion_is_not_split(self):
+        self.assertEqual(split_opinion("A short opinion.", max_tokens=1000), ["A short opinion."])
+
+    def test_long_paragraph_chunks_overlap(self):
+        text = " ".join(f"word{i}" for i in range(5000))
+        chunks = split_opinion(text, max_tokens=1000, overlap_tokens=200)
+
+        self.assertGreater(len(chunks), 1)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            # The chunk starts with the end of the previous one.
+            self.assertIn(chunk.split("\n")[0][-50:], previous[-1000:])
+
+@requires_encoding
+class PackRequestsTest(unittest.TestCase):
+    def test_requests_stay_within_limits(self):
+        long_opinion = " ".join(f"word{i}" for i in range(30000))
+        opinions = [*split_opinion(long_opinion), "we overrule Smith.", "we overrule Doe.", *split_opinion(long_opinion[:50000])]
+        packed = pack_requests(opinions)
+
+        self.assertEqual(sum(packed, []), list(range(len(opinions))))
+        for indices in packed:
+            self.assertLessEqual(count_request_tokens([opinions[i] for i in indices]), MAX_REQUEST_TOKENS)
+            self.assertLessEqual(MAX_OUTPUT_TOKENS * len(indices), MAX_REQUEST_OUTPUT_TOKENS)
+
+    def test_short_opinions_share_requests(self):
+        self.assertEqual(pack_requests(["we overrule Smith."] * 3), [[0, 1], [2]])
+
+class MergeTreatmentsTest(unittest.TestCase):
+    def test_same_case_in_overlapping_chunks(self):
+        merged = merge_treatments([
+            [{"caseName": "Smith v. Jones", "citation": None}],
+            [{"caseName": "Smith v Jones", "citation": "123 So. 2d 456"}, {"caseName": "Doe v. Roe", "citation": None}],
+        ])
+        self.assertEqual(merged, [
+            {"caseName": "Smith v Jones", "citation": "123 So. 2d 456"},
+            {"caseName": "Doe v. Roe", "citation": None},
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()